@@ -1,15 +1,30 @@
 import os
+import asyncio
+import hmac
+import hashlib
 import secrets
 import time
-from fastapi import FastAPI, HTTPException, Depends, Header
+import orjson
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Path, Body
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, EmailStr
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, EmailStr, Field, TypeAdapter
 from typing import Optional, Literal, List
-from database import create_document, get_documents, db
+from database import create_document, create_documents, get_documents, db, cache
 from schemas import Lead, Retailer, Session, Order, OrderItem
 from bson import ObjectId
+from redis.exceptions import RedisError
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, VerificationError, InvalidHashError
 
-app = FastAPI(title="LastDrop API", version="1.1.0")
+app = FastAPI(title="LastDrop API", version="1.1.0", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,16 +34,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def warm_up_database():
+    # Open the connection pool before the first request instead of lazily on it
+    if db is None:
+        return
+    await db.command("ping")
+
+@app.on_event("startup")
+async def create_indexes():
+    if db is None:
+        return
+    await db["retailer"].create_index("email", unique=True)
+    # Sessions are keyed by _id = sha256(token); the old raw-token index would
+    # reject every token-less session after the first as a duplicate null.
+    # All workers run this concurrently, so losing the race is expected.
+    try:
+        await db["session"].drop_index("token_1")
+    except OperationFailure as e:
+        if e.code != 27:  # IndexNotFound
+            raise
+    await db["session"].create_index("expires_at", expireAfterSeconds=0)
+    # The TTL index ignores non-date values: pre-migration sessions (float
+    # expires_at, raw token) would never match or expire, so remove them
+    await db["session"].delete_many({"expires_at": {"$not": {"$type": "date"}}})
+    await db["order"].create_index([("retailer_id", 1), ("_id", -1)])
+
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "LastDrop backend up"}
 
 @app.get("/api/hello")
-def hello():
+async def hello():
     return {"message": "Hello from the backend API!"}
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -44,7 +85,7 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "❌ Unknown"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -64,9 +105,9 @@ class LeadIn(BaseModel):
     consent: bool = True
 
 @app.post("/api/leads")
-def create_lead(lead: LeadIn):
+async def create_lead(lead: LeadIn):
     try:
-        lead_id = create_document("lead", lead.model_dump())
+        lead_id = await create_document("lead", lead.model_dump(exclude_none=True))
         return {"status": "ok", "id": lead_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -86,104 +127,375 @@ class LoginIn(BaseModel):
 class TokenOut(BaseModel):
     token: str
 
-SALT = "ld_static_salt_v1"  # In production, store a per-user salt + strong hashing
+# Argon2id with a random per-password salt embedded in the encoded hash.
+# time_cost/memory_cost are tuned for roughly 50ms per hash on a single core.
+ph = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=1)
 
 def hash_password(pw: str) -> str:
-    import hashlib
-    digest = hashlib.sha256((SALT + pw).encode()).hexdigest()
-    return f"{SALT}${digest}"
+    return ph.hash(pw)
+
+@lru_cache(maxsize=8)
+def _legacy_salt_state(salt: str):
+    # sha256 state with the salt already absorbed; copied per verify
+    return hashlib.sha256(salt.encode())
+
+def _verify_legacy_password(stored: str, pw: str) -> bool:
+    # Pre-Argon2 records use the format "salt$sha256(salt + pw)"
+    salt, _, digest = stored.partition("$")
+    h = _legacy_salt_state(salt).copy()
+    h.update(pw.encode())
+    return hmac.compare_digest(digest, h.hexdigest())
+
+def verify_password(stored: str, pw: str) -> bool:
+    if not stored:
+        return False
+    if not stored.startswith("$argon2"):
+        return _verify_legacy_password(stored, pw)
+    try:
+        return ph.verify(stored, pw)
+    except (VerifyMismatchError, VerificationError, InvalidHashError):
+        return False
+
+# Verified against when the email is unknown; never matches a real password
+_DUMMY_PASSWORD_HASH = ph.hash(secrets.token_urlsafe(32))
+
+def password_needs_rehash(stored: str) -> bool:
+    return not stored.startswith("$argon2") or ph.check_needs_rehash(stored)
+
+# Argon2 is deliberately CPU-heavy; run it in worker processes so a hash
+# does not stall the event loop (and every other request on this worker).
+# Every uvicorn worker has its own pool, so split the cores between them to
+# bound total processes (and 64 MiB per concurrent hash) across the host.
+# WEB_CONCURRENCY is the worker count (exported by the __main__ launcher);
+# when unset this is a single-process server and gets every core.
+def _new_pw_pool() -> ProcessPoolExecutor:
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    return ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 1) // workers))
+
+_pw_pool = _new_pw_pool()
+
+async def _run_in_pw_pool(fn, *args):
+    global _pw_pool
+    loop = asyncio.get_running_loop()
+    pool = _pw_pool
+    try:
+        return await loop.run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        # A child died (e.g. OOM-killed), which breaks the executor for good; replace it
+        if _pw_pool is pool:
+            _pw_pool = _new_pw_pool()
+            pool.shutdown(wait=False)
+        return await loop.run_in_executor(_pw_pool, fn, *args)
+
+@app.on_event("shutdown")
+def shutdown_pw_pool():
+    _pw_pool.shutdown(wait=False, cancel_futures=True)
 
 @app.post("/api/auth/register")
-def register(data: RegisterIn):
-    # Check if exists
-    existing = list(db["retailer"].find({"email": data.email})) if db else []
-    if existing:
-        raise HTTPException(status_code=400, detail="Account already exists")
+async def register(data: RegisterIn):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
     doc = Retailer(
         email=data.email,
-        password_hash=hash_password(data.password),
+        password_hash=await _run_in_pw_pool(hash_password, data.password),
         company=data.company,
         contact_name=data.contact_name,
-    ).model_dump()
-    rid = create_document("retailer", doc)
+    ).model_dump(exclude_none=True)
+    try:
+        # The unique index on retailer.email rejects existing accounts
+        rid = await create_document("retailer", doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Account already exists")
     return {"status": "ok", "id": rid}
 
 @app.post("/api/auth/login", response_model=TokenOut)
-def login(data: LoginIn):
+async def login(data: LoginIn):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    rec = db["retailer"].find_one({"email": data.email})
-    if not rec or rec.get("password_hash") != hash_password(data.password):
+    rec = await db["retailer"].find_one({"email": data.email})
+    # Always run a full verify so unknown emails cost the same as wrong passwords
+    stored = rec.get("password_hash", "") if rec else _DUMMY_PASSWORD_HASH
+    password_ok = await _run_in_pw_pool(verify_password, stored, data.password)
+    if not rec or not password_ok:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if password_needs_rehash(rec["password_hash"]):
+        # Upgrade legacy SHA-256 records (and outdated Argon2 params) on successful login
+        await db["retailer"].update_one({"_id": rec["_id"]}, {"$set": {"password_hash": await _run_in_pw_pool(hash_password, data.password)}})
     token = secrets.token_urlsafe(32)
-    sess = Session(token=token, retailer_id=str(rec.get("_id")), expires_at=time.time()+60*60*24*7)
-    create_document("session", sess.model_dump())
+    sess = Session(
+        retailer_id=str(rec.get("_id")),
+        retailer_email=rec["email"],
+        expires_at=datetime.now(timezone.utc) + timedelta(days=7),
+    )
+    # Only the token's hash is stored, so a leaked session collection yields no usable tokens
+    await create_document("session", {**sess.model_dump(), "_id": _session_id(token)})
     return TokenOut(token=token)
 
 # Dependency to get current retailer from Bearer token
 
-def get_current_retailer(authorization: Optional[str] = Header(None)):
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not available")
+SESSION_CACHE_TTL = 300  # seconds; never longer than the session itself
+
+# In-process cache, only used without Redis (Redis is the shared layer that
+# logout can invalidate). Kept short because logout cannot reach other workers'
+# copies. One in-flight lookup task per session lets concurrent requests
+# carrying the same token share its outcome.
+LOCAL_SESSION_CACHE_TTL = 5  # seconds
+_sess_cache = TTLCache(maxsize=10_000, ttl=LOCAL_SESSION_CACHE_TTL)
+_sess_inflight = {}
+
+# Sessions logged out recently. A lookup that read the session from Mongo just
+# before logout must not cache it afterwards, so logout leaves a tombstone
+# (locally and in Redis) that outlives any cached entry.
+_sess_revoked = TTLCache(maxsize=10_000, ttl=SESSION_CACHE_TTL)
+
+def _session_id(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def _session_cache_key(sid: str) -> str:
+    return f"sess:{sid}"
+
+def _session_revoked_key(sid: str) -> str:
+    return f"sess-revoked:{sid}"
+
+def _bearer_token(authorization: Optional[str]) -> str:
     if not authorization or not authorization.lower().startswith("bearer "):
         raise HTTPException(status_code=401, detail="Missing token")
-    token = authorization.split(" ", 1)[1]
-    sess = db["session"].find_one({"token": token})
-    if not sess or sess.get("expires_at", 0) < time.time():
+    return authorization.split(" ", 1)[1]
+
+async def _load_session(sid: str) -> dict:
+    if cache is not None:
+        try:
+            raw = await cache.get(_session_cache_key(sid))
+        except RedisError:
+            raw = None  # cache unavailable; fall through to Mongo
+        if raw:
+            # Redis entries never outlive the session, see the TTL below
+            return orjson.loads(raw)
+    # Expired sessions are purged by the TTL index; the filter covers the
+    # window before Mongo's TTL monitor gets to them
+    sess = await db["session"].find_one({"_id": sid, "expires_at": {"$gt": datetime.now(timezone.utc)}})
+    if not sess:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
-    retailer = db["retailer"].find_one({"_id": ObjectId(sess["retailer_id"])}) if ObjectId is not None else None
-    if not retailer:
-        raise HTTPException(status_code=401, detail="Retailer not found")
-    return retailer
+    expires_at = sess["expires_at"].timestamp()
+    # The session carries everything handlers need, so the retailer document is not fetched
+    retailer = {"_id": sess["retailer_id"], "email": sess.get("retailer_email")}
+    entry = {"retailer_id": sess["retailer_id"], "expires_at": expires_at, "retailer": retailer}
+    if cache is not None:
+        ttl = int(min(expires_at - time.time(), SESSION_CACHE_TTL))
+        if ttl > 0:
+            try:
+                await cache.setex(_session_cache_key(sid), ttl, orjson.dumps(entry))
+                # Checked after the write: a logout that raced this lookup has set
+                # its tombstone by now, or will delete the entry itself
+                if await cache.exists(_session_revoked_key(sid)):
+                    await cache.delete(_session_cache_key(sid))
+            except RedisError:
+                pass
+    return entry
+
+async def _fetch_session(sid: str) -> dict:
+    entry = await _load_session(sid)
+    if cache is None and sid not in _sess_revoked:
+        _sess_cache[sid] = entry
+    return entry
+
+def _session_fetch_done(sid: str, task: asyncio.Task):
+    if _sess_inflight.get(sid) is task:
+        del _sess_inflight[sid]
+    if not task.cancelled():
+        task.exception()  # consumed by the waiters; avoid "never retrieved" warnings
+
+async def get_current_retailer(authorization: Optional[str] = Header(None)):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    sid = _session_id(_bearer_token(authorization))
+    entry = _sess_cache.get(sid)
+    if entry is None or entry["expires_at"] < time.time():
+        task = _sess_inflight.get(sid)
+        if task is None:
+            task = asyncio.ensure_future(_fetch_session(sid))
+            _sess_inflight[sid] = task
+            task.add_done_callback(partial(_session_fetch_done, sid))
+        # Every waiter gets the same result or exception (e.g. the 401); shield so a
+        # disconnecting client does not cancel the lookup for the others
+        entry = await asyncio.shield(task)
+    return entry["retailer"]
+
+@app.post("/api/auth/logout")
+async def logout(authorization: Optional[str] = Header(None)):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    sid = _session_id(_bearer_token(authorization))
+    # Tombstone first so in-flight lookups cannot re-cache the session below
+    _sess_revoked[sid] = True
+    if cache is not None:
+        try:
+            await cache.setex(_session_revoked_key(sid), SESSION_CACHE_TTL, 1)
+        except RedisError:
+            pass
+    await db["session"].delete_one({"_id": sid})
+    _sess_cache.pop(sid, None)
+    if cache is not None:
+        try:
+            await cache.delete(_session_cache_key(sid))
+        except RedisError:
+            pass  # the cached entry still expires within SESSION_CACHE_TTL
+    return {"status": "ok"}
 
 # ---------------------- Orders Endpoints (Retailer area) ----------------------
 
 class OrderIn(BaseModel):
     order_number: str
     status: Literal["processing", "shipped", "completed", "cancelled"] = "processing"
-    total_amount: float
+    total_amount: Optional[float] = None  # ignored; computed from items
     currency: str = "EUR"
     items: List[OrderItem] = []
     notes: Optional[str] = None
 
+def _order_total(items: List[OrderItem]) -> float:
+    return round(sum(i.price * i.qty for i in items), 2)
+
+OBJECT_ID_PATTERN = r"^[0-9a-fA-F]{24}$"
+
+def order_oid(order_id: str = Path(..., pattern=OBJECT_ID_PATTERN)) -> ObjectId:
+    # Malformed ids are rejected by FastAPI validation before any DB call
+    return ObjectId(order_id)
+
+class OrderUpdateIn(OrderIn):
+    id: str = Field(..., pattern=OBJECT_ID_PATTERN)
+
+# Bulk payloads are capped like list pages so one request cannot force unbounded work
+MAX_BULK_ORDERS = 200
+
+# Reused for bulk payloads so the whole list is dumped in one pydantic-core call
+_orders_adapter = TypeAdapter(List[OrderIn])
+_order_updates_adapter = TypeAdapter(List[OrderUpdateIn])
+
+# Fields returned to the retailer dashboard
+ORDER_LIST_PROJECTION = {
+    "_id": 1,
+    "order_number": 1,
+    "status": 1,
+    "total_amount": 1,
+    "currency": 1,
+    "items": 1,
+    "notes": 1,
+    "created_at": 1,
+    "updated_at": 1,
+}
+
 @app.get("/api/orders")
-def list_orders(current=Depends(get_current_retailer)):
+async def list_orders(
+    limit: int = Query(50, ge=1, le=200),
+    after: Optional[str] = Query(None, pattern=OBJECT_ID_PATTERN),
+    current=Depends(get_current_retailer),
+):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    orders = list(db["order"].find({"retailer_id": str(current["_id"])}))
-    for o in orders:
-        o["_id"] = str(o["_id"])
-    return {"orders": orders}
+    match = {"retailer_id": str(current["_id"])}
+    if after:
+        match["_id"] = {"$lt": ObjectId(after)}
+    # Keyset pagination over the (retailer_id, _id desc) index, newest first
+    cursor = db["order"].aggregate([
+        {"$match": match},
+        {"$sort": {"_id": -1}},
+        {"$limit": limit},
+        {"$addFields": {"_id": {"$toString": "$_id"}}},
+        {"$project": ORDER_LIST_PROJECTION},
+    ], batchSize=500)
+    orders = await cursor.to_list(limit)
+    next_cursor = orders[-1]["_id"] if len(orders) == limit else None
+    # _id is already a string, so orjson can encode the page as-is
+    return ORJSONResponse({"orders": orders, "next_cursor": next_cursor})
+
+@app.get("/api/orders/stats")
+async def order_stats(current=Depends(get_current_retailer)):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    cursor = db["order"].aggregate([
+        {"$match": {"retailer_id": str(current["_id"])}},
+        {"$group": {"_id": "$status", "total": {"$sum": "$total_amount"}, "count": {"$sum": 1}}},
+        {"$project": {"_id": 0, "status": "$_id", "total": 1, "count": 1}},
+    ])
+    return {"stats": await cursor.to_list(None)}
 
 @app.post("/api/orders")
-def create_order(data: OrderIn, current=Depends(get_current_retailer)):
+async def create_order(data: OrderIn, current=Depends(get_current_retailer)):
     ord_doc = Order(
         retailer_id=str(current["_id"]),
         order_number=data.order_number,
         status=data.status,
-        total_amount=data.total_amount,
+        total_amount=_order_total(data.items),
         currency=data.currency,
         items=data.items,
         notes=data.notes,
-    ).model_dump()
-    oid = create_document("order", ord_doc)
+    ).model_dump(exclude_none=True)
+    oid = await create_document("order", ord_doc)
     return {"status": "ok", "id": oid}
 
+# Bulk routes are declared before /api/orders/{order_id} so "bulk" is not taken as an id
+
+@app.post("/api/orders/bulk")
+async def create_orders_bulk(data: List[OrderIn] = Body(..., max_length=MAX_BULK_ORDERS), current=Depends(get_current_retailer)):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    if not data:
+        return {"status": "ok", "ids": []}
+    rid = str(current["_id"])
+    docs = _orders_adapter.dump_python(data, exclude_none=True)
+    for d, doc in zip(data, docs):
+        doc["retailer_id"] = rid
+        doc["total_amount"] = _order_total(d.items)
+    ids = await create_documents("order", docs)
+    return {"status": "ok", "ids": ids}
+
+@app.put("/api/orders/bulk")
+async def update_orders_bulk(data: List[OrderUpdateIn] = Body(..., max_length=MAX_BULK_ORDERS), current=Depends(get_current_retailer)):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    if not data:
+        return {"status": "ok", "matched": 0, "modified": 0}
+    rid = str(current["_id"])
+    ops = []
+    for d, fields in zip(data, _order_updates_adapter.dump_python(data, exclude_unset=True)):
+        order_id = fields.pop("id")
+        fields.pop("total_amount", None)
+        if "items" in fields:
+            fields["total_amount"] = _order_total(d.items)
+        ops.append(UpdateOne({"_id": ObjectId(order_id), "retailer_id": rid}, {"$set": fields}))
+    res = await db["order"].bulk_write(ops, ordered=False)
+    return {"status": "ok", "matched": res.matched_count, "modified": res.modified_count}
+
 @app.put("/api/orders/{order_id}")
-def update_order(order_id: str, data: OrderIn, current=Depends(get_current_retailer)):
+async def update_order(data: OrderIn, oid: ObjectId = Depends(order_oid), current=Depends(get_current_retailer)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    db["order"].update_one({"_id": ObjectId(order_id), "retailer_id": str(current["_id"])}, {"$set": data.model_dump()})
-    return {"status": "ok"}
+    fields = data.model_dump(exclude_unset=True)
+    fields.pop("total_amount", None)
+    if "items" in fields:
+        fields["total_amount"] = _order_total(data.items)
+    res = await db["order"].find_one_and_update(
+        {"_id": oid, "retailer_id": str(current["_id"])},
+        {"$set": fields},
+        projection={"_id": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not res:
+        raise HTTPException(status_code=404, detail="Order not found")
+    return {"status": "ok", "id": str(res["_id"])}
 
 @app.delete("/api/orders/{order_id}")
-def delete_order(order_id: str, current=Depends(get_current_retailer)):
+async def delete_order(oid: ObjectId = Depends(order_oid), current=Depends(get_current_retailer)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
-    db["order"].delete_one({"_id": ObjectId(order_id), "retailer_id": str(current["_id"])})
+    await db["order"].delete_one({"_id": oid, "retailer_id": str(current["_id"])})
     return {"status": "ok"}
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+    # Workers size their password pools from this, so make sure they see it
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    # Multiple workers require the app as an import string
+    uvicorn.run("main:app", host="0.0.0.0", port=port, loop="uvloop", http="httptools", workers=workers)
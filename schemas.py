@@ -12,6 +12,7 @@ Model name is converted to lowercase for the collection name:
 """
 
 from pydantic import BaseModel, Field, EmailStr
+from datetime import datetime
 from typing import Optional, Literal, List, Dict, Any
 
 # Example schemas (replace with your own):
@@ -59,7 +60,7 @@ class Retailer(BaseModel):
     Collection name: "retailer"
     """
     email: EmailStr = Field(..., description="Login email")
-    password_hash: str = Field(..., description="Password hash with salt, format: salt$hash")
+    password_hash: str = Field(..., description="Argon2id encoded hash (legacy records: salt$sha256)")
     company: Optional[str] = Field(None, description="Company name")
     contact_name: Optional[str] = Field(None, description="Primary contact")
     role: Literal["retailer"] = Field("retailer", description="Account role")
@@ -68,10 +69,11 @@ class Session(BaseModel):
     """
     Session tokens for simple auth.
     Collection name: "session"
+    Stored with _id = sha256(bearer token); the raw token is never persisted.
     """
-    token: str = Field(..., description="Bearer token")
     retailer_id: str = Field(..., description="Retailer document id")
-    expires_at: float = Field(..., description="Unix timestamp expiry")
+    retailer_email: EmailStr = Field(..., description="Retailer login email, denormalized for auth")
+    expires_at: datetime = Field(..., description="Expiry time; purged by a TTL index")
 
 class OrderItem(BaseModel):
     sku: str